@@ -1,57 +1,259 @@
 import os
+import array
+import base64
+import asyncio
 import discord
 import aiohttp
+import orjson
+import google_crc32c
 from discord.ext import commands
 from google.cloud import storage
-from http.server import BaseHTTPRequestHandler, HTTPServer
-import threading
-import io
+from google.auth.transport.requests import Request
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+import tempfile
+import time
+import functools
+import re
+import logging
+from contextlib import asynccontextmanager
+from datetime import date as _date, datetime, timezone
 
 TOKEN = os.getenv("DISCORD_TOKEN")
 ASSETS_BUCKET = os.getenv("ASSETS_BUCKET", "nba-cover-assets")  # Bucket for qimen and player images
 GCP_PROJECT = os.getenv("GOOGLE_CLOUD_PROJECT")  # Optional GCP project ID
+COVER_GENERATOR_URL = os.getenv("COVER_GENERATOR_URL", "https://cover-generator-169911608314.us-central1.run.app/generate")
+COVER_TIMEOUT = aiohttp.ClientTimeout(total=int(os.getenv("COVER_TIMEOUT", "300")))  # 5 minute default
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(25 * 1024 * 1024)))  # Reject larger attachments before downloading
 
 if not TOKEN:
     raise Exception("Missing DISCORD_TOKEN environment variable")
 
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+log = logging.getLogger("nba-bot")
+
+# ----- Reply templates -----
+_MSG_GENERATING = "🔄 Generating cover image... This may take a moment."
+_MSG_QUEUED = "⏳ Queued (position {}), waiting for a free generator slot..."
+_ERR_TOO_LARGE = "❌ File too large ({:.1f} MB > {:.0f} MB limit)"
+_ERR_DOWNLOAD = "❌ Failed to download image. Status: {}"
+_ERR_UPLOAD_FAIL = "❌ Error uploading image: {}"
+_ERR_SERVICE = "❌ **Error from cover generator service (status {}):**\n```{}```"
+_ERR_NET = "❌ **Network error calling cover generator:**\n```{}```"
+_ERR_COVER = "❌ **Error generating cover:**\n```{}```"
+
 # ----- Cloud Run health check server -----
-def start_health_server():
-    class Handler(BaseHTTPRequestHandler):
-        def do_GET(self):
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(b"OK")
+_HEALTH_RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nOK"
 
-    port = int(os.getenv("PORT", "8080"))
-    server = HTTPServer(("", port), Handler)
-    print(f"Health check server running on port {port}")
-    server.serve_forever()
+async def _handle_health(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Answer any request with a canned 200 OK; the request itself is never parsed"""
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        writer.write(_HEALTH_RESPONSE)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        # TCP-only probes connect and hang up without sending a request
+        pass
+    finally:
+        writer.close()
 
-threading.Thread(target=start_health_server, daemon=True).start()
+async def start_health_server() -> asyncio.Server:
+    """Serve the health check on the bot's own event loop (no extra thread)"""
+    port = int(os.getenv("PORT", "8080"))
+    server = await asyncio.start_server(_handle_health, host="", port=port)
+    log.info("Health check server running on port %d", port)
+    return server
 
 # ----- Discord bot setup -----
 intents = discord.Intents.default()
 intents.message_content = True  # Important!
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+class CoverBot(commands.Bot):
+    """Bot that owns a single aiohttp session shared by all commands"""
+    http_session: aiohttp.ClientSession | None = None
+    health_server: asyncio.Server | None = None
+
+    async def setup_hook(self):
+        self.health_server = await start_health_server()
+        await asyncio.to_thread(_warm_gcs)
+
+        # One pooled session for the bot's lifetime so repeated requests to the
+        # Discord CDN / cover generator reuse keep-alive connections
+        self.http_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=300),
+            connector=aiohttp.TCPConnector(
+                limit=100,
+                limit_per_host=20,
+                use_dns_cache=True,
+                ttl_dns_cache=300,  # Cache Discord CDN / Cloud Run IPs for 5 minutes
+                keepalive_timeout=75,
+                enable_cleanup_closed=True
+            ),
+            headers={
+                "Connection": "keep-alive",
+                "Accept-Encoding": "gzip, deflate"
+            }
+        )
+
+    async def close(self):
+        await super().close()
+        if self.http_session is not None:
+            await self.http_session.close()
+        if self.health_server is not None:
+            self.health_server.close()
+            await self.health_server.wait_closed()
+
+bot = CoverBot(command_prefix="!", intents=intents)
 
 # Initialize storage client with project if available
 storage_client = storage.Client(project=GCP_PROJECT) if GCP_PROJECT else storage.Client()
 assets_bucket = storage_client.bucket(ASSETS_BUCKET)
 
-async def upload_to_assets_bucket(content: bytes, path: str, content_type: str) -> str:
-    """Upload content to the assets bucket at the specified path"""
-    blob = assets_bucket.blob(path)
-    blob.upload_from_string(content, content_type=content_type)
-    
+# Widen the client's urllib3 pool (default 10) so concurrent upload threads don't
+# contend for connections, and retry transient 5xx without a new TLS handshake
+storage_client._http.mount("https://", HTTPAdapter(
+    pool_connections=50,
+    pool_maxsize=50,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504))
+))
+
+def _warm_gcs():
+    """Fetch the OAuth token and bucket metadata up front so the first upload doesn't pay for it"""
+    try:
+        storage_client._credentials.refresh(Request())
+        assets_bucket.reload()
+    except Exception:
+        # Not fatal: uploads still work (e.g. object-only IAM without storage.buckets.get)
+        log.warning("GCS warm-up failed", exc_info=True)
+
+# Attachment bytes are pulled off the socket in DOWNLOAD_CHUNK_BYTES pieces and
+# forwarded to GCS in UPLOAD_CHUNK_BYTES pieces (must be a multiple of 256 KiB)
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+UPLOAD_CHUNK_BYTES = 256 * 1024
+COVER_SPOOL_MAX_BYTES = 4 * 1024 * 1024
+
+SIGNED_URL_TTL = 3600  # 1 hour
+
+# Cap concurrent calls to the cover generator so a burst of commands queues here
+# instead of stampeding Cloud Run into scale-out
+_COVER_SEM = asyncio.Semaphore(int(os.getenv("COVER_MAX_CONCURRENCY", "4")))
+_cover_waiting = 0
+
+_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+def _safe_fromisoformat(value: str) -> bool:
+    """Return True if value is a real calendar date (rejects e.g. 2025-02-30)"""
+    try:
+        _date.fromisoformat(value)
+        return True
+    except ValueError:
+        return False
+
+@functools.lru_cache(maxsize=1024)
+def _assets_blob(path: str) -> storage.Blob:
+    """Return a reusable Blob handle for a path in the assets bucket"""
+    return assets_bucket.blob(path)
+
+@functools.lru_cache(maxsize=1024)
+def _sign(path: str, bucket_hour: int) -> str:
+    """
+    Generate a v4 signed GET URL for path, cached per hour bucket.
+    The URL expires an hour after the bucket ends, so a cached URL is always valid for at least SIGNED_URL_TTL.
+    """
+    expiration = datetime.fromtimestamp((bucket_hour + 2) * SIGNED_URL_TTL, tz=timezone.utc)
+    return _assets_blob(path).generate_signed_url(
+        version="v4",
+        expiration=expiration,
+        method="GET"
+    )
+
+def _persisted_end(resp: aiohttp.ClientResponse) -> int:
+    """Return how many bytes a 308 response reports as persisted (Range: bytes=0-N)"""
+    range_header = resp.headers.get("Range")
+    if not range_header:
+        return 0
+    return int(range_header.rpartition("-")[2]) + 1
+
+async def _put_chunk(
+    session: aiohttp.ClientSession,
+    upload_url: str,
+    chunk: bytes,
+    offset: int,
+    size: int,
+    crc32c: str | None = None,
+):
+    """
+    PUT one chunk of a resumable upload; GCS answers 308 until the last byte arrives.
+    Any tail of the chunk that the 308's Range header doesn't cover is sent again,
+    and the final PUT carries the object's CRC32C so GCS verifies the whole upload.
+    """
+    end = offset + len(chunk)
+    is_last = end >= size
+    while True:
+        if chunk:
+            content_range = f"bytes {offset}-{end - 1}/{size}"
+        else:
+            # No bytes left to send: status query that finalizes a fully received upload
+            content_range = f"bytes */{size}"
+        headers = {"Content-Range": content_range}
+        if is_last and crc32c:
+            headers["X-Goog-Hash"] = f"crc32c={crc32c}"
+
+        async with session.put(upload_url, data=chunk, headers=headers) as resp:
+            if is_last and resp.status in (200, 201):
+                return
+            if resp.status != 308:
+                error_text = await resp.text()
+                raise RuntimeError(f"GCS upload failed (status {resp.status}): {error_text[:200]}")
+            persisted = _persisted_end(resp)
+
+        if persisted > end:
+            raise RuntimeError(f"GCS upload out of sync: {persisted} bytes persisted, expected {end}")
+        if persisted == end:
+            if not is_last:
+                return
+            if not chunk:
+                raise RuntimeError(f"GCS upload not finalized after all {size} bytes were persisted")
+            # Every byte is stored but the upload wasn't completed; finalize with a status query
+            chunk = b""
+            offset = end
+            continue
+        if persisted <= offset:
+            raise RuntimeError(f"GCS upload stalled: {persisted} bytes persisted, expected {end}")
+        # Resend only the part GCS didn't keep
+        chunk = chunk[persisted - offset:]
+        offset = persisted
+
+async def _pump_chunks(session: aiohttp.ClientSession, stream: aiohttp.StreamReader, upload_url: str, size: int):
+    """Forward a response body to a resumable upload session as it arrives"""
+    buffer = bytearray()
+    offset = 0
+    # Running CRC32C of everything forwarded, checked by GCS on the final PUT
+    checksum = google_crc32c.Checksum()
+    async for data in stream.iter_chunked(DOWNLOAD_CHUNK_BYTES):
+        checksum.update(data)
+        buffer += data
+        while len(buffer) >= UPLOAD_CHUNK_BYTES and offset + UPLOAD_CHUNK_BYTES < size:
+            await _put_chunk(session, upload_url, bytes(buffer[:UPLOAD_CHUNK_BYTES]), offset, size)
+            del buffer[:UPLOAD_CHUNK_BYTES]
+            offset += UPLOAD_CHUNK_BYTES
+
+    # A short (or overlong) body must not be finalized as if it were complete
+    received = offset + len(buffer)
+    if received != size:
+        raise RuntimeError(f"Attachment stream ended at {received} of {size} bytes")
+
+    # Final chunk carries the remaining bytes and completes the upload
+    crc32c = base64.b64encode(checksum.digest()).decode("ascii")
+    await _put_chunk(session, upload_url, bytes(buffer), offset, size, crc32c)
+
+async def _signed_url(path: str) -> str:
+    """Return a signed URL for path, or its gs:// path when the credentials can't sign"""
     # Try to generate signed URL (requires service account with private key)
     # If using application-default credentials (user credentials), fall back to public URL
     try:
-        url = blob.generate_signed_url(
-            version="v4",
-            expiration=3600,  # 1 hour
-            method="GET"
-        )
+        bucket_hour = int(time.time()) // SIGNED_URL_TTL
+        url = await asyncio.to_thread(_sign, path, bucket_hour)
         return url
     except Exception as e:
         # If signed URL generation fails (e.g., no private key), use public URL
@@ -63,9 +265,66 @@ async def upload_to_assets_bucket(content: bytes, path: str, content_type: str)
             # Re-raise if it's a different error
             raise
 
+async def upload_to_assets_bucket(stream: aiohttp.StreamReader, size: int, path: str, content_type: str) -> str:
+    """Stream content from an HTTP response body to the assets bucket at the specified path"""
+    blob = _assets_blob(path)
+    # google-cloud-storage is blocking; run it off the event loop so gateway
+    # heartbeats and other commands keep flowing
+    upload_url = await asyncio.to_thread(
+        blob.create_resumable_upload_session, content_type=content_type, size=size
+    )
+
+    # v4 URLs can be signed before the object exists, so hide the signing cost
+    # behind the transfer instead of paying it afterwards
+    _, url = await asyncio.gather(
+        _pump_chunks(bot.http_session, stream, upload_url, size),
+        _signed_url(path)
+    )
+    return url
+
+async def _extract_image_attachment(ctx: commands.Context) -> discord.Attachment | None:
+    """Return the message's first attachment if it is an image, otherwise reply with the error and return None"""
+    if not ctx.message.attachments:
+        await ctx.reply("❌ Please attach an image to upload.")
+        return None
+    
+    # Get the first image attachment
+    attachment = ctx.message.attachments[0]
+    if not attachment.content_type or not attachment.content_type.startswith("image/"):
+        await ctx.reply("❌ The attachment must be an image file.")
+        return None
+    
+    if attachment.size and attachment.size > MAX_UPLOAD_BYTES:
+        await ctx.reply(_ERR_TOO_LARGE.format(attachment.size / 1e6, MAX_UPLOAD_BYTES / 1e6))
+        return None
+    
+    return attachment
+
+@asynccontextmanager
+async def _cover_slot(status_msg: discord.Message):
+    """Hold a cover generator slot, showing the queue position on status_msg while waiting"""
+    global _cover_waiting
+    queued = _COVER_SEM.locked()
+    if queued:
+        _cover_waiting += 1
+        try:
+            await status_msg.edit(content=_MSG_QUEUED.format(_cover_waiting))
+            await _COVER_SEM.acquire()
+        finally:
+            _cover_waiting -= 1
+    else:
+        await _COVER_SEM.acquire()
+    
+    try:
+        if queued:
+            await status_msg.edit(content=_MSG_GENERATING)
+        yield
+    finally:
+        _COVER_SEM.release()
+
 @bot.event
 async def on_ready():
-    print(f"Bot logged in as {bot.user}")
+    log.info("Bot logged in as %s", bot.user)
 
 @bot.command(name="upload_qimen")
 async def upload_qimen(ctx: commands.Context, filename: str):
@@ -74,36 +333,28 @@ async def upload_qimen(ctx: commands.Context, filename: str):
     Usage: !upload_qimen <filename>
     Example: !upload_qimen 2025-12-07.jpg
     """
-    if not ctx.message.attachments:
-        await ctx.reply("❌ Please attach an image to upload.")
-        return
-    
-    # Get the first image attachment
-    attachment = ctx.message.attachments[0]
-    if not attachment.content_type or not attachment.content_type.startswith("image/"):
-        await ctx.reply("❌ The attachment must be an image file.")
+    attachment = await _extract_image_attachment(ctx)
+    if attachment is None:
         return
     
     try:
-        # Download the image
-        async with aiohttp.ClientSession() as session:
-            async with session.get(attachment.url) as resp:
-                if resp.status != 200:
-                    await ctx.reply(f"❌ Failed to download image. Status: {resp.status}")
-                    return
-                content = await resp.read()
-        
-        # Upload to GCS at qimen/filename
+        # Stream the image from Discord to GCS at qimen/filename
         gcs_path = f"qimen/{filename}"
-        url = await upload_to_assets_bucket(
-            content=content,
-            path=gcs_path,
-            content_type=attachment.content_type
-        )
+        async with bot.http_session.get(attachment.url) as resp:
+            if resp.status != 200:
+                await ctx.reply(_ERR_DOWNLOAD.format(resp.status))
+                return
+            url = await upload_to_assets_bucket(
+                stream=resp.content,
+                size=attachment.size,
+                path=gcs_path,
+                content_type=attachment.content_type
+            )
         
         await ctx.reply(f"✅ **Uploaded qimen image**\n`gs://{ASSETS_BUCKET}/{gcs_path}`\n{url}")
     except Exception as e:
-        await ctx.reply(f"❌ Error uploading image: {str(e)}")
+        log.exception("upload_qimen failed", extra={"filename": filename})
+        await ctx.reply(_ERR_UPLOAD_FAIL.format(e))
 
 @bot.command(name="upload_player")
 async def upload_player(ctx: commands.Context, filename: str):
@@ -112,36 +363,28 @@ async def upload_player(ctx: commands.Context, filename: str):
     Usage: !upload_player <filename>
     Example: !upload_player LAL_Doncic.png
     """
-    if not ctx.message.attachments:
-        await ctx.reply("❌ Please attach an image to upload.")
-        return
-    
-    # Get the first image attachment
-    attachment = ctx.message.attachments[0]
-    if not attachment.content_type or not attachment.content_type.startswith("image/"):
-        await ctx.reply("❌ The attachment must be an image file.")
+    attachment = await _extract_image_attachment(ctx)
+    if attachment is None:
         return
     
     try:
-        # Download the image
-        async with aiohttp.ClientSession() as session:
-            async with session.get(attachment.url) as resp:
-                if resp.status != 200:
-                    await ctx.reply(f"❌ Failed to download image. Status: {resp.status}")
-                    return
-                content = await resp.read()
-        
-        # Upload to GCS at players/filename
+        # Stream the image from Discord to GCS at players/filename
         gcs_path = f"players/{filename}"
-        url = await upload_to_assets_bucket(
-            content=content,
-            path=gcs_path,
-            content_type=attachment.content_type
-        )
+        async with bot.http_session.get(attachment.url) as resp:
+            if resp.status != 200:
+                await ctx.reply(_ERR_DOWNLOAD.format(resp.status))
+                return
+            url = await upload_to_assets_bucket(
+                stream=resp.content,
+                size=attachment.size,
+                path=gcs_path,
+                content_type=attachment.content_type
+            )
         
         await ctx.reply(f"✅ **Uploaded player image**\n`gs://{ASSETS_BUCKET}/{gcs_path}`\n{url}")
     except Exception as e:
-        await ctx.reply(f"❌ Error uploading image: {str(e)}")
+        log.exception("upload_player failed", extra={"filename": filename})
+        await ctx.reply(_ERR_UPLOAD_FAIL.format(e))
 
 @bot.command(name="generate_cover")
 async def generate_cover_command(ctx: commands.Context, date: str, away_team: str, home_team: str, *args):
@@ -165,22 +408,24 @@ async def generate_cover_command(ctx: commands.Context, date: str, away_team: st
                           "**Example:** `!generate_cover 2025-12-07 HOU GSW \"火旺克金形势显\" \"刺锋遇曜力难前\" 2 4`")
             return
         
-        title_lines = list(args[:2])
-        circle_cells = [int(x) for x in args[2:]] if len(args) > 2 else []
+        title_lines = args[:2]  # Tuples serialize as JSON arrays
         
-        # Validate date format
+        # Cell numbers 1-9 fit in a signed byte
         try:
-            from datetime import datetime
-            datetime.strptime(date, "%Y-%m-%d")
-        except ValueError:
+            circle_cells = array.array("b", (int(x) for x in args[2:]))
+        except (ValueError, OverflowError):
+            circle_cells = None
+        if circle_cells is None or not all(1 <= c <= 9 for c in circle_cells):
+            await ctx.reply("❌ circle_cells must be integers 1-9")
+            return
+        
+        # Validate date format
+        if not _DATE_RE.match(date) or not _safe_fromisoformat(date):
             await ctx.reply("❌ Invalid date format. Use YYYY-MM-DD (e.g., 2025-12-07)")
             return
         
         # Send "generating" message
-        generating_msg = await ctx.reply("🔄 Generating cover image... This may take a moment.")
-        
-        # Get the cover generator service URL from environment variable or use default
-        COVER_GENERATOR_URL = os.getenv("COVER_GENERATOR_URL", "https://cover-generator-169911608314.us-central1.run.app/generate")
+        generating_msg = await ctx.reply(_MSG_GENERATING)
         
         # Prepare request payload
         payload = {
@@ -192,35 +437,38 @@ async def generate_cover_command(ctx: commands.Context, date: str, away_team: st
         
         # Add circle_cells if provided
         if circle_cells:
-            payload["circle_cells"] = circle_cells
+            payload["circle_cells"] = circle_cells.tolist()
         
         # Call the external service
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
+        async with _cover_slot(generating_msg):
+            async with bot.http_session.post(
                 COVER_GENERATOR_URL,
-                json=payload,
-                headers={"Content-Type": "application/json"},
-                timeout=aiohttp.ClientTimeout(total=300)  # 5 minute timeout
+                data=orjson.dumps(payload),  # Raw UTF-8, no \uXXXX escaping of the Chinese titles
+                headers={"Content-Type": "application/json; charset=utf-8"},
+                timeout=COVER_TIMEOUT
             ) as resp:
                 if resp.status == 200:
-                    # Read the image data
-                    image_data = await resp.read()
+                    # discord.File needs a seekable file, so spool the body chunk by
+                    # chunk rather than reading it into one bytes object
+                    with tempfile.SpooledTemporaryFile(max_size=COVER_SPOOL_MAX_BYTES) as spool:
+                        async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_BYTES):
+                            spool.write(chunk)
+                        spool.seek(0)
                     
-                    # Send the generated file
-                    file = discord.File(io.BytesIO(image_data), filename=f"cover_{date}.jpg")
-                    await generating_msg.edit(content="✅ **Cover generated!**")
-                    await ctx.send(file=file)
+                        # Send the generated file
+                        file = discord.File(spool, filename=f"cover_{date}.jpg")
+                        await generating_msg.edit(content="✅ **Cover generated!**")
+                        await ctx.send(file=file)
                 else:
                     error_text = await resp.text()
-                    await generating_msg.edit(content=f"❌ **Error from cover generator service (status {resp.status}):**\n```{error_text[:500]}```")
+                    await generating_msg.edit(content=_ERR_SERVICE.format(resp.status, error_text[:500]))
                 
     except aiohttp.ClientError as e:
-        await ctx.reply(f"❌ **Network error calling cover generator:**\n```{str(e)}```")
+        await ctx.reply(_ERR_NET.format(e))
     except Exception as e:
-        import traceback
         error_msg = str(e)
-        traceback.print_exc()
-        await ctx.reply(f"❌ **Error generating cover:**\n```{error_msg}```")
+        log.exception("generate_cover failed", extra={"date": date, "teams": (away_team, home_team)})
+        await ctx.reply(_ERR_COVER.format(error_msg))
 
 # Run the Discord bot
 bot.run(TOKEN)
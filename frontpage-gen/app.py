@@ -4,8 +4,12 @@ Exposes the cover generation functionality as a REST API for Cloud Run deploymen
 """
 from flask import Flask, request, jsonify, send_file
 import os
-from generate_cover import generate_cover, get_random_background, get_player_paths
-from gcs_utils import download_from_gcs, is_gcs_path
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+from generate_cover import generate_cover, get_random_background, get_player_paths, warm_qimen_kernel
+from gcs_utils import download_from_gcs, download_many_from_gcs, iter_gcs_files, prefetch
 import traceback
 
 app = Flask(__name__)
@@ -50,6 +54,43 @@ def get_asset_path(asset_type, filename=None):
         else:
             return os.path.join(SCRIPT_DIR, asset_type)
 
+# Shared pool for overlapping the per-request listing/download round trips
+_REQUEST_POOL = ThreadPoolExecutor(max_workers=12, thread_name_prefix="generate-io")
+
+# Static overlay assets bundled in the image, decoded once at startup.
+# Stored as RGBA arrays (not shared PIL Images) and wrapped in a fresh Image per request.
+ASSET_FILES = ("taiji.png", "fog.png", "circle-red.png", "footer.png")
+_ASSET_CACHE = {
+    name: np.asarray(Image.open(get_asset_path("assets", name)).convert("RGBA"))
+    for name in ASSET_FILES
+    if os.path.exists(get_asset_path("assets", name))
+}
+
+def get_cached_asset(filename):
+    """Return a bundled asset as a PIL Image from the decode cache, or its path if it wasn't cached"""
+    arr = _ASSET_CACHE.get(filename)
+    if arr is None:
+        return get_asset_path("assets", filename)
+    return Image.fromarray(arr, "RGBA")
+
+def prefetch_gcs_assets():
+    """Download all backgrounds and player images into the local cache"""
+    try:
+        prefetch(
+            get_asset_path(asset_type, filename)
+            for asset_type in ("backgrounds", "players")
+            for filename in iter_gcs_files(get_asset_path(asset_type))
+        )
+    except Exception as e:
+        print(f"Asset prefetch failed: {e}")
+
+# Compile (or load from the numba cache) the qimen kernel off the request path
+threading.Thread(target=warm_qimen_kernel, name="qimen-warmup", daemon=True).start()
+
+# Warm the GCS cache in the background so the first requests don't pay for downloads
+if GCS_BUCKET:
+    threading.Thread(target=prefetch_gcs_assets, name="gcs-prefetch", daemon=True).start()
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint for Cloud Run"""
@@ -90,33 +131,33 @@ def generate():
         
         # Define paths (GCS or local based on GCS_BUCKET env var)
         backgrounds_dir = get_asset_path("backgrounds")
-        bg_path = get_random_background(backgrounds_dir=backgrounds_dir)
-        
+        players_dir = get_asset_path("players")
         qimen_file = f"{today_str}.jpg"
         qimen_path = get_asset_path("qimen", qimen_file)
         
-        # Get player paths
-        players_dir = get_asset_path("players")
-        player_paths = get_player_paths(
-            away_team, 
-            home_team, 
-            players_dir=players_dir
+        # The background pick, the player lookup and the qimen download are independent,
+        # so run them concurrently; each listing's download starts as soon as it resolves
+        # (convert GCS paths to local paths)
+        bg_future = _REQUEST_POOL.submit(
+            lambda: download_from_gcs(get_random_background(backgrounds_dir=backgrounds_dir))
+        )
+        players_future = _REQUEST_POOL.submit(
+            lambda: download_many_from_gcs(get_player_paths(away_team, home_team, players_dir=players_dir))
         )
+        qimen_future = _REQUEST_POOL.submit(download_from_gcs, qimen_path)
         
-        # Build asset paths
-        taiji_path = get_asset_path("assets", "taiji.png")
-        fog_path = get_asset_path("assets", "fog.png")
-        circle_path = get_asset_path("assets", "circle-red.png")
-        footer_path = get_asset_path("assets", "footer.png")
+        # Bundled overlay assets (pre-decoded at startup)
+        taiji_path = get_cached_asset("taiji.png")
+        fog_path = get_cached_asset("fog.png")
+        circle_path = get_cached_asset("circle-red.png")
+        footer_path = get_cached_asset("footer.png")
         output_dir = os.path.join(SCRIPT_DIR, "output")
         
-        # Download files from GCS if needed (convert GCS paths to local paths)
+        # Wait for the downloads (all paths are local after this)
         # Note: assets/ (taiji, fog, circle, footer) are bundled in the image, so don't download from GCS
-        bg_path = download_from_gcs(bg_path) if is_gcs_path(bg_path) else bg_path
-        qimen_path = download_from_gcs(qimen_path) if is_gcs_path(qimen_path) else qimen_path
-        player_paths = [download_from_gcs(p) if is_gcs_path(p) else p for p in player_paths]
-        # Assets are bundled in the image, so they should already be local paths
-        # taiji_path, fog_path, circle_path, footer_path are not downloaded from GCS
+        bg_path = bg_future.result()
+        player_paths = players_future.result()
+        qimen_path = qimen_future.result()
         
         # Generate cover (all paths are now local)
         output_name = f"cover_{today_str}.jpg"
@@ -3,35 +3,210 @@ Utilities for downloading assets from Google Cloud Storage.
 Supports both GCS bucket paths and local file paths for backward compatibility.
 """
 import os
-import tempfile
+import re
+import time
+import fcntl
+import threading
+import functools
+import contextlib
+from fnmatch import fnmatchcase
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import storage
-from typing import Optional
+from google.cloud.storage import transfer_manager
+from google.cloud.storage.retry import DEFAULT_RETRY
+from urllib.parse import quote, urlsplit
+from requests.adapters import HTTPAdapter
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
 import logging
 
 logger = logging.getLogger(__name__)
 
-# Cache directory for downloaded files
+# Any checksummed transfer should use the C (SSE4.2 / ARMv8 CRC) implementation
+try:
+    import google_crc32c
+    if google_crc32c.implementation != "c":
+        logger.warning("google-crc32c C extension unavailable; CRC32C checks will run in pure Python")
+except ImportError:
+    pass
+
+# Cache directory for downloaded files (persists across restarts)
 _cache_dir = None
 
+# Seconds a cached file is trusted before its generation is re-checked in GCS
+CACHE_TTL = int(os.environ.get("COVER_GEN_CACHE_TTL", "300"))
+
+# In-memory LRU of file contents: path -> ((mtime_ns, size), bytes)
+MEM_CACHE_MAX_BYTES = int(os.environ.get("COVER_GEN_MEM_CACHE_MB", "256")) * 1024 * 1024
+_mem_cache = OrderedDict()
+_mem_cache_bytes = 0
+_mem_cache_lock = threading.Lock()
+
+# Shared storage client (authenticates once, reuses its HTTP connections)
+_GCS = None
+_GCS_LOCK = threading.Lock()
+
+# Connection pool size for the shared client (requests defaults to 10)
+HTTP_POOL_SIZE = 32
+
+def get_client() -> storage.Client:
+    """Get the shared storage client, creating it on first use"""
+    global _GCS
+    if _GCS is None:
+        with _GCS_LOCK:
+            if _GCS is None:
+                client = storage.Client()
+                # Larger pool so concurrent downloads don't queue for a connection
+                client._http.mount("https://", HTTPAdapter(
+                    pool_connections=HTTP_POOL_SIZE,
+                    pool_maxsize=HTTP_POOL_SIZE,
+                ))
+                _GCS = client
+    return _GCS
+
+# Read size for streaming reads via open_gcs (must be a multiple of 256 KiB).
+# Not set on download blobs: a blob chunk_size switches download_to_filename to a
+# chunked download, which ignores single_shot_download and drops the response headers.
+DOWNLOAD_CHUNK_BYTES = 8 * 1024 * 1024
+
+# Assets are stored uncompressed, so skip decoding and chunked range requests
+_DOWNLOAD_KWARGS = {
+    "raw_download": True,
+    "checksum": None,
+    "single_shot_download": True,
+}
+
+@functools.lru_cache(maxsize=None)
+def _get_bucket(bucket_name: str) -> storage.Bucket:
+    """Get a cached bucket handle on the shared client"""
+    return get_client().bucket(bucket_name)
+
 def get_cache_dir():
     """Get or create the cache directory for downloaded files"""
     global _cache_dir
     if _cache_dir is None:
-        _cache_dir = tempfile.mkdtemp(prefix="cover_gen_cache_")
-        logger.info(f"Created cache directory: {_cache_dir}")
+        _cache_dir = os.environ.get("COVER_GEN_CACHE") or os.path.join(
+            os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+            "cover_gen",
+        )
+        os.makedirs(_cache_dir, exist_ok=True)
+        logger.info(f"Using cache directory: {_cache_dir}")
     return _cache_dir
 
+def _cache_path(bucket_name: str, blob_path: str) -> str:
+    """Mirror gs://bucket/blob_path under the cache directory"""
+    parts = blob_path.split("/")
+    if any(part in ("", ".", "..") for part in parts):
+        # Empty, "." or ".." segments can't be mirrored without aliasing or escaping the cache
+        raise ValueError(f"Cannot cache GCS object with this name: gs://{bucket_name}/{blob_path}")
+    local_path = os.path.join(get_cache_dir(), bucket_name, *parts)
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    return local_path
+
+def _is_fresh(blob: storage.Blob, local_path: str) -> bool:
+    """Check whether a cached file still matches the blob's object name and generation in GCS"""
+    try:
+        st = os.stat(local_path)
+    except FileNotFoundError:
+        return False
+    if time.time() - st.st_mtime < CACHE_TTL:
+        return True
+    
+    try:
+        with open(f"{local_path}.meta") as f:
+            cached_name, _, cached_generation = f.read().strip().partition("\n")
+    except FileNotFoundError:
+        return False
+    if cached_name != f"gs://{blob.bucket.name}/{blob.name}" or not cached_generation.isdigit():
+        # Unusable sidecar (another object's entry, or an unknown generation): re-download
+        return False
+    
+    # Partial-response metadata GET: only generation and size, not the whole object resource
+    resource = get_client()._connection.api_request(
+        method="GET",
+        path=f"/b/{blob.bucket.name}/o/{quote(blob.name, safe='')}",
+        query_params={"fields": "generation,size"},
+        retry=DEFAULT_RETRY,
+    )
+    if str(resource.get("generation")) != cached_generation:
+        # Keep the new size so the re-download can preallocate the file, and the
+        # generation as a fallback in case the download response doesn't carry it
+        # (the download resets it from the response headers)
+        blob._properties["size"] = resource.get("size")
+        blob._properties["generation"] = resource.get("generation")
+        return False
+    # Unchanged in GCS: trust the cached copy for another TTL
+    os.utime(local_path)
+    return True
+
+def _file_version(path: str) -> Optional[Tuple[int, int, int]]:
+    """Identify the current state of a cache file, or None if it doesn't exist"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+@contextlib.contextmanager
+def _download_lock(local_path: str):
+    """Hold an exclusive cross-process lock while a cache entry is downloaded"""
+    with open(f"{local_path}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+def _discard(path: str) -> None:
+    """Remove a file if it exists"""
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(path)
+
+def _finalize_download(
+    blob: storage.Blob, tmp_path: str, local_path: str, known_generation: Optional[int] = None
+) -> None:
+    """Atomically move a finished download into place and record its object name and generation"""
+    # Prefer the generation from the download response; fall back to the one
+    # the revalidation GET saw before the download started
+    generation = blob.generation or known_generation
+    os.replace(tmp_path, local_path)
+    if generation is None:
+        # Without a generation the entry can't be revalidated; drop any old sidecar
+        # so it is simply re-downloaded once the TTL expires
+        logger.warning(f"No generation for {blob.name}; {local_path} will be re-downloaded after the TTL")
+        _discard(f"{local_path}.meta")
+        return
+    meta_tmp = f"{tmp_path}.meta"
+    with open(meta_tmp, "w") as f:
+        f.write(f"gs://{blob.bucket.name}/{blob.name}\n{generation}")
+    os.replace(meta_tmp, f"{local_path}.meta")
+
 def is_gcs_path(path: str) -> bool:
     """Check if a path is a GCS path (gs://bucket/path)"""
     return path.startswith("gs://")
 
+@functools.lru_cache(maxsize=1024)
+def _parse_gs(gcs_path: str) -> Tuple[str, str]:
+    """Split gs://bucket/path into (bucket, path); the path may be empty for a bucket root"""
+    parts = urlsplit(gcs_path, allow_fragments=False)
+    if parts.scheme != "gs" or not parts.netloc:
+        raise ValueError(f"Invalid GCS path format: {gcs_path}")
+    # "?" is legal in object names; urlsplit files it under query
+    path = f"{parts.path}?{parts.query}" if parts.query else parts.path
+    return parts.netloc, path.lstrip("/")
+
+def _parse_gcs_path(gcs_path: str) -> Tuple[str, str]:
+    """Split gs://bucket/path/to/file into (bucket, blob path)"""
+    bucket_name, blob_path = _parse_gs(gcs_path)
+    if not blob_path:
+        raise ValueError(f"Invalid GCS path format: {gcs_path}")
+    return bucket_name, blob_path
+
 def download_from_gcs(gcs_path: str, local_filename: Optional[str] = None) -> str:
     """
     Download a file from GCS to local cache.
     
     Args:
         gcs_path: GCS path in format gs://bucket/path/to/file
-        local_filename: Optional local filename (defaults to basename of GCS path)
+        local_filename: Optional local filename (defaults to the bucket and object path
+            mirrored under the cache directory)
     
     Returns:
         Local file path
@@ -41,78 +216,285 @@ def download_from_gcs(gcs_path: str, local_filename: Optional[str] = None) -> st
         return gcs_path
     
     # Parse GCS path: gs://bucket/path/to/file
-    parts = gcs_path.replace("gs://", "").split("/", 1)
-    if len(parts) != 2:
-        raise ValueError(f"Invalid GCS path format: {gcs_path}")
+    bucket_name, blob_path = _parse_gcs_path(gcs_path)
     
-    bucket_name = parts[0]
-    blob_path = parts[1]
-    
-    # Determine local filename
+    # Determine local path
     if local_filename is None:
-        local_filename = os.path.basename(blob_path)
-    
-    # Check cache first
-    cache_dir = get_cache_dir()
-    local_path = os.path.join(cache_dir, local_filename)
+        local_path = _cache_path(bucket_name, blob_path)
+    else:
+        local_path = os.path.join(get_cache_dir(), local_filename)
     
-    if os.path.exists(local_path):
+    blob = _get_bucket(bucket_name).blob(blob_path)
+    version = _file_version(local_path)
+    if _is_fresh(blob, local_path):
         logger.info(f"Using cached file: {local_path}")
         return local_path
     
-    # Download from GCS
-    logger.info(f"Downloading {gcs_path} to {local_path}")
-    client = storage.Client()
-    bucket = client.bucket(bucket_name)
-    blob = bucket.blob(blob_path)
-    
-    blob.download_to_filename(local_path)
+    with _download_lock(local_path):
+        # Another process may have finished the download while we waited; only
+        # look again if the file changed, so the stale verdict costs one metadata GET
+        if _file_version(local_path) != version and _is_fresh(blob, local_path):
+            logger.info(f"Using cached file: {local_path}")
+            return local_path
+        
+        # Download from GCS (to a temp file so readers never see a partial file)
+        logger.info(f"Downloading {gcs_path} to {local_path}")
+        tmp_path = f"{local_path}.{os.getpid()}.tmp"
+        known_generation = blob.generation
+        try:
+            if blob.size and hasattr(os, "posix_fallocate"):
+                # Size known from revalidation: reserve it in one extent before writing
+                with open(tmp_path, "wb") as f:
+                    os.posix_fallocate(f.fileno(), 0, blob.size)
+                    blob.download_to_file(f, **_DOWNLOAD_KWARGS)
+                    f.truncate()
+            else:
+                blob.download_to_filename(tmp_path, **_DOWNLOAD_KWARGS)
+            _finalize_download(blob, tmp_path, local_path, known_generation)
+        except BaseException:
+            _discard(tmp_path)
+            raise
     logger.info(f"Downloaded to {local_path}")
     
     return local_path
 
-def list_gcs_files(gcs_dir: str, prefix: str = "") -> list:
+def download_many_from_gcs(gcs_paths: List[str], max_workers: int = 32) -> List[str]:
     """
-    List files in a GCS directory.
+    Download several files from GCS to local cache concurrently.
+    
+    Args:
+        gcs_paths: GCS paths (local paths are passed through unchanged)
+        max_workers: Maximum number of concurrent downloads
+    
+    Returns:
+        Local file paths, in the same order as gcs_paths
+    """
+    cache_dir = get_cache_dir()
+    local_paths = []
+    pending = {}
+    for gcs_path in gcs_paths:
+        if not is_gcs_path(gcs_path):
+            local_paths.append(gcs_path)
+            continue
+        
+        bucket_name, blob_path = _parse_gcs_path(gcs_path)
+        local_path = _cache_path(bucket_name, blob_path)
+        local_paths.append(local_path)
+        if local_path in pending:
+            continue
+        blob = _get_bucket(bucket_name).blob(blob_path)
+        version = _file_version(local_path)
+        if not _is_fresh(blob, local_path):
+            pending[local_path] = (blob, version)
+    
+    if not pending:
+        return local_paths
+    
+    with contextlib.ExitStack() as locks:
+        # Lock in a fixed order so concurrent batches can't deadlock
+        for local_path in sorted(pending):
+            locks.enter_context(_download_lock(local_path))
+        # Drop entries another process finished while we waited (only files
+        # that changed since the first check are looked at again)
+        pending = {
+            p: blob for p, (blob, version) in pending.items()
+            if _file_version(p) == version or not _is_fresh(blob, p)
+        }
+        if pending:
+            logger.info(f"Downloading {len(pending)} files to {cache_dir}")
+            pid = os.getpid()
+            pairs = [(blob, f"{local_path}.{pid}.tmp") for local_path, blob in pending.items()]
+            known_generations = [blob.generation for blob, _ in pairs]
+            try:
+                transfer_manager.download_many(
+                    pairs,
+                    download_kwargs=dict(_DOWNLOAD_KWARGS),  # download_many mutates this
+                    max_workers=min(max_workers, len(pairs)),
+                    worker_type=transfer_manager.THREAD,
+                    raise_exception=True,
+                )
+                for (blob, tmp_path), local_path, known in zip(pairs, pending, known_generations):
+                    _finalize_download(blob, tmp_path, local_path, known)
+            except BaseException:
+                # Don't leave partial (possibly preallocated) temp files in the persistent cache
+                for _, tmp_path in pairs:
+                    _discard(tmp_path)
+                raise
+    
+    return local_paths
+
+def open_gcs(path: str) -> BinaryIO:
+    """
+    Open a file for streaming reads without going through the disk cache.
+    
+    Args:
+        path: GCS path (gs://bucket/path/to/file) or local file path
+    
+    Returns:
+        Binary file object; GCS objects are read in DOWNLOAD_CHUNK_BYTES ranges
+    """
+    if not is_gcs_path(path):
+        return open(path, "rb")
+    bucket_name, blob_path = _parse_gcs_path(path)
+    blob = _get_bucket(bucket_name).blob(blob_path)
+    return blob.open("rb", chunk_size=DOWNLOAD_CHUNK_BYTES, raw_download=True)
+
+def get_bytes(path: str) -> bytes:
+    """
+    Read a file's contents through a bounded in-memory LRU cache.
+    GCS paths go through the local disk cache first; entries are validated with
+    a single os.stat (mtime and size) so a replaced file is re-read.
+    
+    Args:
+        path: GCS path (gs://bucket/path/to/file) or local file path
+    
+    Returns:
+        File contents
+    """
+    global _mem_cache_bytes
+    local_path = download_from_gcs(path)
+    st = os.stat(local_path)
+    version = (st.st_mtime_ns, st.st_size)
+    
+    with _mem_cache_lock:
+        entry = _mem_cache.get(local_path)
+        if entry is not None and entry[0] == version:
+            _mem_cache.move_to_end(local_path)
+            return entry[1]
+    
+    with open(local_path, "rb") as f:
+        if hasattr(os, "posix_fadvise"):
+            # Whole-file read: ask the kernel for aggressive readahead
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        data = f.read()
+    if len(data) > MEM_CACHE_MAX_BYTES:
+        return data
+    
+    with _mem_cache_lock:
+        old = _mem_cache.pop(local_path, None)
+        if old is not None:
+            _mem_cache_bytes -= len(old[1])
+        _mem_cache[local_path] = (version, data)
+        _mem_cache_bytes += len(data)
+        # Evict least recently used entries until back under the limit
+        while _mem_cache_bytes > MEM_CACHE_MAX_BYTES:
+            _, (_, evicted) = _mem_cache.popitem(last=False)
+            _mem_cache_bytes -= len(evicted)
+    return data
+
+def prefetch(gcs_paths: Iterable[str], max_workers: int = 16) -> None:
+    """
+    Warm the local cache by downloading files concurrently.
+    Failures are logged and skipped, since the request path downloads on a miss anyway.
+    
+    Args:
+        gcs_paths: GCS paths to fetch (local paths and already-cached files are skipped)
+        max_workers: Maximum number of concurrent downloads (kept within HTTP_POOL_SIZE)
+    """
+    cache_dir = get_cache_dir()
+    todo = []
+    for path in gcs_paths:
+        if not is_gcs_path(path):
+            continue
+        try:
+            local_path = _cache_path(*_parse_gcs_path(path))
+        except ValueError as e:
+            logger.warning(f"Prefetch skipped {path}: {e}")
+            continue
+        if not os.path.exists(local_path):
+            todo.append(path)
+    if not todo:
+        return
+    
+    logger.info(f"Prefetching {len(todo)} files into {cache_dir}")
+    with ThreadPoolExecutor(max_workers=min(max_workers, HTTP_POOL_SIZE, len(todo))) as executor:
+        futures = [(path, executor.submit(download_from_gcs, path)) for path in todo]
+        for path, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                logger.warning(f"Prefetch failed for {path}: {e}")
+
+def _expand_braces(pattern: str) -> List[str]:
+    """Expand {a,b} alternatives in a glob into plain fnmatch patterns"""
+    match = re.search(r"\{([^{}]*)\}", pattern)
+    if match is None:
+        return [pattern]
+    head, tail = pattern[:match.start()], pattern[match.end():]
+    return [p for alt in match.group(1).split(",") for p in _expand_braces(head + alt + tail)]
+
+def iter_gcs_files(gcs_dir: str, prefix: str = "", match_glob: Optional[str] = None) -> Iterator[str]:
+    """
+    Iterate over files in a GCS directory, yielding names as listing pages arrive.
     
     Args:
         gcs_dir: GCS path in format gs://bucket/path/to/dir
         prefix: Optional prefix to filter files
+        match_glob: Optional glob on the file name (e.g. "bg_*.png" or "{HOU,GSW}_*.png"),
+            evaluated server-side for GCS directories
     
-    Returns:
-        List of file names (not full paths)
+    Yields:
+        File names (not full paths)
     """
     if not is_gcs_path(gcs_dir):
         # Local directory
         local_dir = os.path.join(gcs_dir, prefix) if prefix else gcs_dir
-        if not os.path.exists(local_dir):
-            return []
-        return [f for f in os.listdir(local_dir) if os.path.isfile(os.path.join(local_dir, f))]
+        patterns = _expand_braces(match_glob) if match_glob else None
+        try:
+            # scandir carries the entry type from the directory read (no per-file stat)
+            with os.scandir(local_dir) as entries:
+                for entry in entries:
+                    if not entry.is_file():
+                        continue
+                    if patterns is None or any(fnmatchcase(entry.name, p) for p in patterns):
+                        yield entry.name
+        except FileNotFoundError:
+            pass
+        return
     
     # Parse GCS path
-    parts = gcs_dir.replace("gs://", "").split("/", 1)
-    bucket_name = parts[0]
-    dir_path = parts[1] if len(parts) > 1 else ""
+    bucket_name, dir_path = _parse_gs(gcs_dir)
     
     # Build full prefix
     full_prefix = f"{dir_path}/{prefix}" if dir_path and prefix else (dir_path or prefix)
     if full_prefix and not full_prefix.endswith("/"):
         full_prefix += "/"
     
-    client = storage.Client()
-    bucket = client.bucket(bucket_name)
-    blobs = bucket.list_blobs(prefix=full_prefix)
+    # Only fetch object names, and only this directory level (like os.listdir).
+    # A glob's "*" doesn't cross "/", so it needs no delimiter to stay at this level.
+    if match_glob:
+        listing = {"match_glob": full_prefix + match_glob}
+    else:
+        listing = {"delimiter": "/"}
+    blobs = get_client().list_blobs(
+        _get_bucket(bucket_name),
+        prefix=full_prefix,
+        fields="items(name),nextPageToken",
+        page_size=1000,
+        **listing,
+    )
     
     # Extract just the filenames
-    files = []
     for blob in blobs:
         if blob.name.endswith("/"):  # Skip directories
             continue
         filename = os.path.basename(blob.name)
         if filename:
-            files.append(filename)
+            yield filename
+
+def list_gcs_files(gcs_dir: str, prefix: str = "", match_glob: Optional[str] = None) -> list:
+    """
+    List files in a GCS directory.
+    
+    Args:
+        gcs_dir: GCS path in format gs://bucket/path/to/dir
+        prefix: Optional prefix to filter files
+        match_glob: Optional glob on the file name, evaluated server-side for GCS directories
     
-    return files
+    Returns:
+        List of file names (not full paths)
+    """
+    return list(iter_gcs_files(gcs_dir, prefix, match_glob))
 
 def get_gcs_path(bucket: str, *path_parts: str) -> str:
     """Construct a GCS path from bucket and path parts"""
@@ -1,10 +1,95 @@
 from PIL import Image, ImageDraw, ImageFont, ImageEnhance, ImageFilter
+import numpy as np
 import os
-from rembg import remove
+from rembg import new_session, remove
 import io
+import re
 import random
 import argparse
-from gcs_utils import list_gcs_files, is_gcs_path
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from gcs_utils import iter_gcs_files, is_gcs_path, get_bytes, open_gcs
+
+try:
+    import numba
+except ImportError:  # numba不可用时退回Pillow逐步处理
+    numba = None
+
+# rembg模型会话（ONNX InferenceSession），首次使用时加载一次，之后所有请求复用
+REMBG_MODEL = os.environ.get("REMBG_MODEL", "u2netp")
+_REMBG_SESSION = None
+_REMBG_SESSION_LOCK = threading.Lock()
+
+def get_rembg_session():
+    """获取共享的rembg会话（线程安全的延迟初始化）"""
+    global _REMBG_SESSION
+    if _REMBG_SESSION is None:
+        with _REMBG_SESSION_LOCK:
+            if _REMBG_SESSION is None:
+                _REMBG_SESSION = new_session(REMBG_MODEL)
+    return _REMBG_SESSION
+
+if numba is not None:
+    @numba.njit(cache=True, inline="always")
+    def _contrast_px(v, mean, contrast):
+        """单个通道值的对比度变换（与ImageEnhance.Contrast的blend一致，截断到0-255）"""
+        t = mean + contrast * (v - mean)
+        if t <= 0.0:
+            return 0.0
+        if t >= 255.0:
+            return 255.0
+        return float(int(t))
+
+    @numba.njit(parallel=True, cache=True)
+    def _qimen_fuse(arr, mean, threshold, contrast, sharpness, remove_white):
+        """
+        一次遍历完成qimen图的三个步骤：白色背景透明化 + 对比度 + 锐度。
+        锐度与ImageEnhance.Sharpness一致：与SMOOTH 3x3滤波结果做blend，边缘像素不滤波。
+        """
+        height, width = arr.shape[0], arr.shape[1]
+        out = np.empty_like(arr)
+        for y in numba.prange(height):
+            for x in range(width):
+                inner = 0 < y < height - 1 and 0 < x < width - 1
+                for ch in range(3):
+                    c = _contrast_px(arr[y, x, ch], mean, contrast)
+                    if inner:
+                        acc = 4.0 * c
+                        for dy in range(-1, 2):
+                            for dx in range(-1, 2):
+                                acc += _contrast_px(arr[y + dy, x + dx, ch], mean, contrast)
+                        smooth = float(int(acc / 13.0 + 0.5))
+                    else:
+                        smooth = c
+                    v = smooth + sharpness * (c - smooth)
+                    out[y, x, ch] = 0 if v <= 0.0 else (255 if v >= 255.0 else int(v))
+                if remove_white and arr[y, x, 0] > threshold and arr[y, x, 1] > threshold and arr[y, x, 2] > threshold:
+                    out[y, x, 3] = 0
+                else:
+                    out[y, x, 3] = arr[y, x, 3]
+        return out
+else:
+    _qimen_fuse = None
+
+def warm_qimen_kernel():
+    """预先编译/加载_qimen_fuse（首次调用约需1-2秒），参数类型与fuse_qimen_image一致"""
+    if _qimen_fuse is None:
+        return
+    # np.asarray(PIL图片)得到只读数组，numba按只读类型单独编译，这里保持一致
+    arr = np.asarray(Image.new("RGBA", (3, 3), (255, 255, 255, 255)))
+    _qimen_fuse(arr, 255.0, 240, 1.5, 2.0, True)
+
+# 字体缓存：按 (路径, 字号) 缓存已解析的字体对象，避免每次请求重复读取和解析TTF
+_FONT_CACHE = {}
+
+def _get_font(path=None, size=None):
+    """获取缓存的字体对象；path为None时返回Pillow默认字体"""
+    key = (path, size)
+    font = _FONT_CACHE.get(key)
+    if font is None:
+        font = ImageFont.truetype(path, size) if path else ImageFont.load_default()
+        _FONT_CACHE[key] = font
+    return font
 
 def generate_cover(
     bg_path,
@@ -35,11 +120,11 @@ def generate_cover(
     - output_dir: 输出文件夹
     - image_size: 最终输出图片的尺寸 (宽, 高)
     - font_path: 字体文件路径 (可选)
-    - taiji_path: 太极图片路径 (可选)
-    - fog_path: 雾气图片路径 (可选)
-    - circle_path: 圆圈图片路径，用于叠加在指定格子上 (可选)
+    - taiji_path: 太极图片路径或已加载的PIL Image (可选)
+    - fog_path: 雾气图片路径或已加载的PIL Image (可选)
+    - circle_path: 圆圈图片路径或已加载的PIL Image，用于叠加在指定格子上 (可选)
     - circle_cells: 要叠加圆圈的格子编号列表 (1-9)，九宫格编号：[[1,2,3],[4,5,6],[7,8,9]] (可选)
-    - footer_path: 底部页脚图片路径，叠加在所有图层最上层 (可选)
+    - footer_path: 底部页脚图片路径或已加载的PIL Image，叠加在所有图层最上层 (可选)
     """
     
     # 确保输出目录存在
@@ -48,76 +133,60 @@ def generate_cover(
     def remove_background(image_path):
         """使用rembg移除图片背景"""
         try:
-            with open(image_path, 'rb') as f:
-                input_image = f.read()
+            input_image = get_bytes(image_path)
             # 使用rembg移除背景
-            output_image = remove(input_image)
-            # 转换为PIL Image
-            return Image.open(io.BytesIO(output_image)).convert("RGBA")
+            output_image = remove(input_image, session=get_rembg_session())
+            # 转换为PIL Image（在工作线程中完成解码）
+            return load_rgba(io.BytesIO(output_image))
         except Exception as e:
             print(f"警告：移除背景失败，使用原图。路径：{image_path}，错误：{e}")
             # 如果失败，返回原图
-            return Image.open(image_path).convert("RGBA")
+            return load_rgba(image_path)
     
     def remove_white_background(img, threshold=240):
         """移除白色背景，将其转换为透明"""
-        # 确保图片是RGBA格式
-        if img.mode != "RGBA":
-            img = img.convert("RGBA")
+        # 如果图片已经有透明区域（背景已移除），直接返回，避免误删接近白色的前景像素
+        if img.mode == "RGBA" and img.getextrema()[3][0] < 255:
+            return img
         
-        # 获取像素数据
-        data = img.getdata()
+        # 确保图片是RGBA格式，并复制为可写的数组
+        arr = np.array(img.convert("RGBA"), copy=True)
         
-        # 创建新的像素列表
-        new_data = []
-        for item in data:
-            # 如果像素接近白色（RGB值都大于threshold），则设置为透明
-            if item[0] > threshold and item[1] > threshold and item[2] > threshold:
-                new_data.append((255, 255, 255, 0))  # 完全透明
-            else:
-                new_data.append(item)  # 保持原像素
+        # 如果像素接近白色（RGB值都大于threshold），则设置为透明（向量化处理）
+        white = (arr[..., 0] > threshold) & (arr[..., 1] > threshold) & (arr[..., 2] > threshold)
+        arr[white, 3] = 0
         
         # 创建新图片
-        img.putdata(new_data)
-        return img
+        return Image.fromarray(arr, "RGBA")
     
-    def enhance_contrast(img, factor=1.5):
-        """增强图片对比度，使文字和符号更清晰"""
-        # 分离RGB和alpha通道
-        if img.mode == "RGBA":
-            rgb = img.convert("RGB")
-            alpha = img.split()[3]
-            # 增强对比度
-            enhancer = ImageEnhance.Contrast(rgb)
-            rgb_enhanced = enhancer.enhance(factor)
-            # 合并回RGBA
-            img = Image.merge("RGBA", (*rgb_enhanced.split(), alpha))
-        else:
-            # 如果不是RGBA，直接增强
-            enhancer = ImageEnhance.Contrast(img)
-            img = enhancer.enhance(factor)
-        return img
+    def split_rgba(img):
+        """将RGBA图片一次性拆分为 (RGB图片, alpha通道)，供后续处理步骤复用"""
+        if img.mode != "RGBA":
+            img = img.convert("RGBA")
+        bands = img.split()
+        return Image.merge("RGB", bands[:3]), bands[3]
     
-    def enhance_sharpness(img, factor=2.0):
-        """增强图片锐度，使边缘更清晰"""
-        if img.mode == "RGBA":
-            rgb = img.convert("RGB")
-            alpha = img.split()[3]
-            # 增强锐度
-            enhancer = ImageEnhance.Sharpness(rgb)
-            rgb_enhanced = enhancer.enhance(factor)
-            # 合并回RGBA
-            img = Image.merge("RGBA", (*rgb_enhanced.split(), alpha))
-        else:
-            enhancer = ImageEnhance.Sharpness(img)
-            img = enhancer.enhance(factor)
-        return img
+    def merge_rgba(rgb, a):
+        """将 (RGB图片, alpha通道) 合并回RGBA（原地添加alpha通道）"""
+        rgb.putalpha(a)
+        return rgb
     
-    def enhance_qimen_image(img):
-        """增强qimen图片清晰度：对比度 + 锐度"""
-        img = enhance_contrast(img, factor=1.5)
-        img = enhance_sharpness(img, factor=2.0)
-        return img
+    def fuse_qimen_image(img, threshold=240, contrast=1.5, sharpness=2.0):
+        """用numba内核一次性完成 remove_white_background + enhance_qimen_image"""
+        arr = np.asarray(img.convert("RGBA"))
+        # 已有透明区域时不做白色背景移除（与remove_white_background一致）
+        remove_white = int(arr[..., 3].min()) == 255
+        # 对比度的灰度均值，与ImageEnhance.Contrast相同（L = 0.299R + 0.587G + 0.114B）
+        rgb = arr[..., :3].astype(np.uint32)
+        lum = (rgb[..., 0] * 19595 + rgb[..., 1] * 38470 + rgb[..., 2] * 7471 + 0x8000) >> 16
+        mean = float(int(lum.mean() + 0.5))
+        return Image.fromarray(_qimen_fuse(arr, mean, threshold, contrast, sharpness, remove_white), "RGBA")
+    
+    def enhance_qimen_image(rgb, a, contrast=1.5, sharpness=2.0):
+        """增强qimen图片清晰度：对比度 + 锐度（只处理RGB，alpha原样传递）"""
+        rgb = ImageEnhance.Contrast(rgb).enhance(contrast)
+        rgb = ImageEnhance.Sharpness(rgb).enhance(sharpness)
+        return rgb, a
     
     def crop_to_content(img):
         """裁剪图片，只保留非透明像素的区域"""
@@ -126,61 +195,87 @@ def generate_cover(
             img = img.convert("RGBA")
         
         # 获取alpha通道
-        alpha = img.split()[3]
+        alpha = np.asarray(img.getchannel("A"))
         
-        # 获取非透明像素的边界框
-        bbox = alpha.getbbox()
+        # 按行/列查找非透明像素
+        rows = np.any(alpha, axis=1)
+        cols = np.any(alpha, axis=0)
         
-        if bbox:
-            # 裁剪到边界框
-            return img.crop(bbox)
-        else:
+        if not rows.any():
             # 如果没有非透明像素，返回原图
             return img
-    
-    def feather_edges(img, feather_radius=3):
-        """为图片边缘添加羽化效果，使边缘更柔和"""
-        if img.mode != "RGBA":
-            img = img.convert("RGBA")
         
-        # 获取alpha通道
-        alpha = img.split()[3]
-        
-        # 对alpha通道应用高斯模糊，创建羽化效果
-        alpha_feathered = alpha.filter(ImageFilter.GaussianBlur(radius=feather_radius))
-        
-        # 合并回RGBA
-        r, g, b = img.split()[:3]
-        return Image.merge("RGBA", (r, g, b, alpha_feathered))
+        # 获取非透明像素的边界框并裁剪
+        top = int(np.argmax(rows))
+        bottom = len(rows) - int(np.argmax(rows[::-1]))
+        left = int(np.argmax(cols))
+        right = len(cols) - int(np.argmax(cols[::-1]))
+        return img.crop((left, top, right, bottom))
+    
+    def feather_edges(rgb, a, feather_radius=3):
+        """为图片边缘添加羽化效果，使边缘更柔和（只处理alpha，RGB原样传递）"""
+        # 对alpha通道应用盒式模糊，创建羽化效果（单次box pass，比GaussianBlur的多次pass更省）
+        return rgb, a.filter(ImageFilter.BoxBlur(feather_radius))
     
     def set_alpha(img, alpha_ratio):
         """设置图片的透明度（alpha_ratio: 0.0-1.0）"""
         if img.mode == "RGBA":
-            r, g, b, a = img.split()
-            a = a.point(lambda x: int(x * alpha_ratio))
-            return Image.merge("RGBA", (r, g, b, a))
+            # 只取出alpha通道处理，无需拆分/合并全部通道
+            # 预先计算查找表，Pillow直接走C查表路径，无需Python回调
+            lut = [int(i * alpha_ratio) for i in range(256)]
+            a = img.getchannel("A").point(lut)
+            img = img.copy()
+            img.putalpha(a)
         return img
     
-    def create_handwritten_text_image(text, font, text_color=(10, 10, 10), padding=50):
-        """创建手写风格的文字图片"""
-        # 测量文字大小
-        temp_draw = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
-        bbox = temp_draw.textbbox((0, 0), text, font=font)
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]
-        
-        # 创建临时画布
-        temp_img = Image.new('RGBA', (text_width + padding * 2, text_height + padding * 2), (0, 0, 0, 0))
-        temp_draw = ImageDraw.Draw(temp_img)
-        
-        # 绘制文字（单层，无粗体效果）
-        temp_draw.text((padding, padding), text, font=font, fill=(*text_color, 255))
-        
-        return crop_to_content(temp_img)
+    def tight_composite(base, overlay, pos):
+        """只在overlay的非透明边界框内进行alpha合成（跳过完全透明的区域）"""
+        bbox = overlay.getbbox()  # RGBA图片只检查alpha通道
+        if not bbox:
+            return
+        base.alpha_composite(overlay, dest=(pos[0] + bbox[0], pos[1] + bbox[1]), source=bbox)
+    
+    def load_rgba(image_path, draft_size=None):
+        """打开图片并解码为RGBA（在线程池中调用）；也接受已加载的PIL Image（返回副本）"""
+        if isinstance(image_path, Image.Image):
+            return image_path.convert("RGBA")
+        if isinstance(image_path, str) and is_gcs_path(image_path):
+            # 未缓存的GCS图片：边下载边解码，不落盘
+            with open_gcs(image_path) as f:
+                return load_rgba(f, draft_size)
+        if isinstance(image_path, str):
+            # 经由内存LRU缓存读取文件内容，重复使用的图片不再读盘
+            image_path = io.BytesIO(get_bytes(image_path))
+        img = Image.open(image_path)
+        if draft_size:
+            # 让JPEG解码器直接按比例缩小解码（PNG无影响），减少后续缩放的像素量
+            img.draft("RGB", draft_size)
+        # Image.open是惰性的，显式load()确保解码在当前工作线程完成（解码期间释放GIL）
+        img.load()
+        return img.convert("RGBA")
+
+    # 0. 并行解码各图层图片，后续步骤通过 .result() 取用（解码异常也在对应步骤中抛出）
+    image_sources = {
+        "bg": bg_path,
+        "taiji": taiji_path,
+        "qimen": qimen_path,
+        "fog": fog_path if qimen_path else None,
+        "circle": circle_path if qimen_path and circle_cells else None,
+        "footer": footer_path,
+    }
+    decode_executor = ThreadPoolExecutor(max_workers=len(image_sources))
+    decoded = {
+        name: decode_executor.submit(
+            load_rgba, path,
+            draft_size=(image_size[0] * 2, image_size[1] * 2) if name == "bg" else None
+        )
+        for name, path in image_sources.items() if path
+    }
+    decode_executor.shutdown(wait=False)
 
     # 1. 加载背景图并裁剪到指定尺寸（保持宽高比，居中裁剪）
     try:
-        bg_img = Image.open(bg_path).convert("RGBA")
+        bg_img = decoded["bg"].result()
         
         # 计算裁剪区域以保持宽高比
         bg_aspect = bg_img.width / bg_img.height
@@ -201,7 +296,7 @@ def generate_cover(
         
         # 裁剪并调整大小
         background = bg_img.crop((left, top, left + new_width, top + new_height))
-        background = background.resize(image_size, Image.LANCZOS)
+        background = background.resize(image_size, Image.LANCZOS, reducing_gap=2.0)
     except FileNotFoundError:
         print(f"错误：背景图片未找到，路径：{bg_path}")
         return
@@ -212,14 +307,14 @@ def generate_cover(
     # 2. 叠加太极图 - 放置在背景之上，但位于玩家和奇门图之下
     if taiji_path:
         try:
-            taiji_img = Image.open(taiji_path).convert("RGBA")
+            taiji_img = decoded["taiji"].result()
             # 计算尺寸：35%的背景高度，保持宽高比
             taiji_height = int(image_size[1] * 0.35)
             aspect_ratio = taiji_img.width / taiji_img.height
             taiji_width = int(taiji_height * aspect_ratio)
             
-            # 调整大小
-            taiji_img = taiji_img.resize((taiji_width, taiji_height), Image.LANCZOS)
+            # 调整大小（30%透明度下Lanczos的细节无法分辨，使用更快的BICUBIC）
+            taiji_img = taiji_img.resize((taiji_width, taiji_height), Image.BICUBIC, reducing_gap=2.0)
             
             # 调整透明度为30%
             taiji_img = set_alpha(taiji_img, 0.3)
@@ -229,7 +324,7 @@ def generate_cover(
             taiji_y = image_size[1] - taiji_height - int(image_size[1] * 0.05)
             taiji_pos = (taiji_x, taiji_y)
             
-            background.alpha_composite(taiji_img, taiji_pos)
+            tight_composite(background, taiji_img, taiji_pos)
         except FileNotFoundError:
             print(f"警告：太极图片未找到，跳过。路径：{taiji_path}")
         except Exception as e:
@@ -238,11 +333,15 @@ def generate_cover(
     # 3. 叠加奇门遁甲盘 - 居中放置，50%宽度，保持正方形比例
     if qimen_path:
         try:
-            qimen_plate = Image.open(qimen_path).convert("RGBA")
-            # 移除白色背景
-            qimen_plate = remove_white_background(qimen_plate)
-            # 使用选择的增强方法提高清晰度
-            qimen_plate = enhance_qimen_image(qimen_plate)
+            qimen_plate = decoded["qimen"].result()
+            if _qimen_fuse is not None:
+                # 移除白色背景 + 增强清晰度，单次并行遍历
+                qimen_plate = fuse_qimen_image(qimen_plate)
+            else:
+                # 移除白色背景
+                qimen_plate = remove_white_background(qimen_plate)
+                # 使用选择的增强方法提高清晰度
+                qimen_plate = merge_rgba(*enhance_qimen_image(*split_rgba(qimen_plate)))
             # 计算尺寸：50%宽度，保持正方形
             qimen_size = int(image_size[0] * 0.5)
             # 保持原始宽高比，但限制在qimen_size内
@@ -251,15 +350,15 @@ def generate_cover(
             qimen_x = (image_size[0] - qimen_plate.width) // 2
             qimen_y = (image_size[1] - qimen_plate.height) // 2 - int(image_size[1] * 0.09)
             qimen_pos = (qimen_x, qimen_y)
-            background.alpha_composite(qimen_plate, qimen_pos)
+            tight_composite(background, qimen_plate, qimen_pos)
             
             # 3.5. 叠加雾气图 - 放置在qimen图上面，拉伸到与qimen图完全相同的尺寸
             if fog_path:
                 try:
-                    fog_img = Image.open(fog_path).convert("RGBA")
-                    fog_img = fog_img.resize((qimen_plate.width, qimen_plate.height), Image.LANCZOS)
+                    fog_img = decoded["fog"].result()
+                    fog_img = fog_img.resize((qimen_plate.width, qimen_plate.height), Image.BICUBIC, reducing_gap=2.0)
                     fog_img = set_alpha(fog_img, 0.5)
-                    background.alpha_composite(fog_img, qimen_pos)
+                    tight_composite(background, fog_img, qimen_pos)
                 except FileNotFoundError:
                     print(f"警告：雾气图片未找到，跳过。路径：{fog_path}")
                 except Exception as e:
@@ -269,7 +368,7 @@ def generate_cover(
             if circle_path and circle_cells:
                 try:
                     # 加载circle图片一次，在循环外
-                    circle_img_base = Image.open(circle_path).convert("RGBA")
+                    circle_img_base = decoded["circle"].result()
                     
                     # 计算每个格子的大小（resize后的尺寸）
                     cell_width = qimen_plate.width // 3
@@ -279,24 +378,20 @@ def generate_cover(
                     base_circle_size = int(min(cell_width, cell_height) * 0.8)
                     circle_size = int(base_circle_size * 1.728)
                     
+                    # 预先计算两种circle（正常/旋转90度），所有格子复用，避免每个格子重复缩放
+                    # 正方形旋转90度后尺寸不变，无需再次缩放
+                    circle_normal = circle_img_base.resize((circle_size, circle_size), Image.BICUBIC, reducing_gap=2.0)
+                    circle_normal = set_alpha(circle_normal, 0.9)  # 调整透明度至90%
+                    circle_rotated = circle_normal.rotate(-90, expand=True) if len(circle_cells) > 1 else None
+                    
                     # 在每个指定的格子上叠加circle
                     # 九宫格编号：[[1,2,3],[4,5,6],[7,8,9]]
                     # 编号转索引：编号-1 = 内部索引(0-8)
+                    circle_msgs = []  # 日志汇总，循环结束后统一输出一行
                     for idx, cell_num in enumerate(circle_cells):
                         if 1 <= cell_num <= 9:
-                            # 复制并调整大小到统一尺寸
-                            circle_img = circle_img_base.copy()
-                            circle_img = circle_img.resize((circle_size, circle_size), Image.LANCZOS)
-                            
-                            # 如果是第二个circle（索引1），旋转90度
-                            if idx == 1:
-                                circle_img = circle_img.rotate(-90, expand=True)
-                                # 旋转后可能改变尺寸，确保恢复到相同大小
-                                if circle_img.size != (circle_size, circle_size):
-                                    circle_img = circle_img.resize((circle_size, circle_size), Image.LANCZOS)
-                            
-                            # 调整透明度至90%
-                            circle_img = set_alpha(circle_img, 0.9)
+                            # 如果是第二个circle（索引1），使用旋转90度的版本
+                            circle_img = circle_rotated if idx == 1 else circle_normal
                             
                             cell_idx = cell_num - 1  # 转换为0-8的索引
                             row = cell_idx // 3
@@ -311,11 +406,12 @@ def generate_cover(
                             circle_y = qimen_y + cell_top + (cell_height - circle_img.height) // 2
                             circle_pos = (circle_x, circle_y)
                             
-                            background.alpha_composite(circle_img, circle_pos)
+                            tight_composite(background, circle_img, circle_pos)
                             rotation_info = "（旋转90度）" if idx == 1 else ""
-                            print(f"在格子 {cell_num} (位置: row={row}, col={col}) 叠加圆圈{rotation_info}")
+                            circle_msgs.append(f"在格子 {cell_num} (位置: row={row}, col={col}) 叠加圆圈{rotation_info}")
                         else:
-                            print(f"警告：格子编号 {cell_num} 无效，应在1-9之间")
+                            circle_msgs.append(f"警告：格子编号 {cell_num} 无效，应在1-9之间")
+                    print(" | ".join(circle_msgs))
                 except FileNotFoundError:
                     print(f"警告：圆圈图片未找到，跳过。路径：{circle_path}")
                 except Exception as e:
@@ -332,11 +428,15 @@ def generate_cover(
         
         num_players = len(player_paths)
         
+        # 使用rembg并行移除所有球员图片的背景（ONNX推理会释放GIL）
+        with ThreadPoolExecutor(max_workers=num_players) as executor:
+            bg_removed = [executor.submit(remove_background, p) for p in player_paths]
+        
+        player_msgs = []  # 日志汇总，循环结束后统一输出一行
         for idx, player_path in enumerate(player_paths):
             try:
-                # 使用rembg移除背景
-                print(f"正在处理球员图片 {idx + 1}/{num_players}: {player_path}")
-                player_img = remove_background(player_path)
+                player_msgs.append(f"球员图片 {idx + 1}/{num_players}: {player_path}")
+                player_img = bg_removed[idx].result()
                 
                 # 裁剪图片，只保留球员部分（移除透明边缘）
                 player_img = crop_to_content(player_img)
@@ -346,10 +446,10 @@ def generate_cover(
                 player_width = int(player_height * aspect_ratio)
                 
                 # 调整大小
-                player_img = player_img.resize((player_width, player_height), Image.LANCZOS)
+                player_img = player_img.resize((player_width, player_height), Image.LANCZOS, reducing_gap=2.0)
                 
                 # 为边缘添加羽化效果，使边缘更柔和
-                player_img = feather_edges(player_img, feather_radius=5)
+                player_img = merge_rgba(*feather_edges(*split_rgba(player_img), feather_radius=5))
                 
                 # 计算x位置：Player 1在左边1%，Player 2在右边1%
                 if idx == 0:
@@ -359,30 +459,34 @@ def generate_cover(
                 
                 player_pos = (player_x, bottom_y)
                 
-                background.alpha_composite(player_img, player_pos)
+                tight_composite(background, player_img, player_pos)
             except FileNotFoundError:
-                print(f"警告：球员图片未找到，跳过。路径：{player_path}")
+                player_msgs.append(f"警告：球员图片未找到，跳过。路径：{player_path}")
             except Exception as e:
-                print(f"加载或叠加球员图片时出错：{e}")
+                player_msgs.append(f"加载或叠加球员图片时出错：{e}")
+        print("已处理" + " | ".join(player_msgs))
+
+    # 文字直接绘制在背景上（无需临时图片、裁剪和合成）
+    draw = ImageDraw.Draw(background)
+    text_color = (10, 10, 10, 255)
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    stxingka_path = os.path.join(script_dir, "assets", "STXINGKA.TTF")
 
     # 5. 添加日期 - 左上角
     date_text = today_str
-    date_font = ImageFont.load_default()
-    date_text_img = create_handwritten_text_image(date_text, date_font, text_color=(10, 10, 10))
-    
-    # 缩放图片使日期大小约为标题的一半（标题字体70，日期约35）
-    scale_factor = 3
-    date_text_img = date_text_img.resize(
-        (int(date_text_img.width * scale_factor), int(date_text_img.height * scale_factor)),
-        Image.LANCZOS
-    )
+    # 直接按目标大小加载字体（日期约为标题的一半：标题字体70，日期35），而不是放大默认位图字体
+    try:
+        date_font = _get_font(stxingka_path, 35)
+    except OSError:
+        date_font = _get_font()
     
     # 位置：左上角，留出一些边距
     date_x = int(image_size[0] * 0.02)  # 距离左边2%
     date_y = int(image_size[1] * 0.02)  # 距离顶部2%
     
-    # 绘制日期
-    background.alpha_composite(date_text_img, (date_x, date_y))
+    # 绘制日期（按文字实际边界对齐，使字形左上角落在(date_x, date_y)）
+    date_bbox = draw.textbbox((0, 0), date_text, font=date_font)
+    draw.text((date_x - date_bbox[0], date_y - date_bbox[1]), date_text, font=date_font, fill=text_color)
 
     # 6. 添加标题文字 - 手写风格
     if title_lines:
@@ -393,44 +497,41 @@ def generate_cover(
         # 1. 尝试使用指定的字体路径
         if font_path and os.path.exists(font_path):
             try:
-                font = ImageFont.truetype(font_path, font_size)
+                font = _get_font(font_path, font_size)
             except:
                 pass
         
         # 2. 尝试加载STXINGKA.TTF
         if font is None:
-            script_dir = os.path.dirname(os.path.abspath(__file__))
-            stxingka_path = os.path.join(script_dir, "assets", "STXINGKA.TTF")
             if os.path.exists(stxingka_path):
                 try:
-                    font = ImageFont.truetype(stxingka_path, font_size)
+                    font = _get_font(stxingka_path, font_size)
                 except:
                     pass
         
         # 3. 使用默认字体
         if font is None:
-            font = ImageFont.load_default()
+            font = _get_font()
         
         # 计算文字位置和绘制
-        text_color = (10, 10, 10, 255)
         line_height = font_size + 10
         start_y = int(image_size[1] * 0.095)
         
         for line_idx, line_text in enumerate(title_lines):
-            # 创建手写风格的文字图片
-            text_img = create_handwritten_text_image(line_text, font, text_color=(10, 10, 10))
+            # 测量文字实际边界
+            left, top, right, _ = draw.textbbox((0, 0), line_text, font=font)
             
             # 计算位置并居中
-            text_x = (image_size[0] - text_img.width) // 2
+            text_x = (image_size[0] - (right - left)) // 2
             text_y = start_y + line_idx * line_height
             
             # 绘制文字
-            background.alpha_composite(text_img, (text_x, text_y))
+            draw.text((text_x - left, text_y - top), line_text, font=font, fill=text_color)
 
     # 7. 叠加footer图片 - 底部，所有图层最上层
     if footer_path:
         try:
-            footer_img = Image.open(footer_path).convert("RGBA")
+            footer_img = decoded["footer"].result()
             
             # 计算footer的宽度，为背景宽度的25%，保持宽高比
             footer_width = int(image_size[0] * 0.25)
@@ -438,14 +539,14 @@ def generate_cover(
             footer_height = int(footer_width * aspect_ratio)
             
             # 调整footer大小
-            footer_img = footer_img.resize((footer_width, footer_height), Image.LANCZOS)
+            footer_img = footer_img.resize((footer_width, footer_height), Image.BICUBIC, reducing_gap=2.0)
             
             # 位置：底部对齐，水平居中，向上移动1%
             footer_x = (image_size[0] - footer_width) // 2
             footer_y = image_size[1] - footer_height - int(image_size[1] * 0.01)
             
             # 叠加footer（在所有图层最上层）
-            background.alpha_composite(footer_img, (footer_x, footer_y))
+            tight_composite(background, footer_img, (footer_x, footer_y))
         except FileNotFoundError:
             print(f"警告：footer图片未找到，跳过。路径：{footer_path}")
         except Exception as e:
@@ -453,67 +554,69 @@ def generate_cover(
 
     # 8. 保存图片
     output_path = os.path.join(output_dir, output_filename)
-    background_rgb = Image.new("RGB", background.size, (255, 255, 255))
-    background_rgb.paste(background, mask=background.split()[3] if background.mode == "RGBA" else None)
-    background_rgb.save(output_path, quality=95)
+    if background.getextrema()[3][0] == 255:
+        # 背景完全不透明，直接转换为RGB
+        background_rgb = background.convert("RGB")
+    else:
+        # 存在半透明区域时，用NumPy一次性合成到白色背景上
+        arr = np.asarray(background)
+        a = arr[..., 3:4].astype(np.uint16)
+        rgb = (arr[..., :3].astype(np.uint16) * a + 255 * (255 - a)) // 255
+        background_rgb = Image.fromarray(rgb.astype(np.uint8), "RGB")
+    background_rgb.save(output_path, quality=95, optimize=False, progressive=False, subsampling=2)
     print(f"封面图已保存到: {output_path}")
 
 def get_random_background(backgrounds_dir="backgrounds"):
     """随机选择一个背景文件（支持GCS路径）"""
-    bg_files = list_gcs_files(backgrounds_dir)
-    bg_files = [f for f in bg_files if f.startswith("bg_") and f.endswith(".png")]
+    bg_files = list(iter_gcs_files(backgrounds_dir, match_glob="bg_*.png"))
     bg_file = random.choice(bg_files) if bg_files else "bg_001.png"
     print(f"随机选择背景: {bg_file}")
     
     # Return full path (GCS or local)
     if is_gcs_path(backgrounds_dir):
         from gcs_utils import get_gcs_path
-        bucket = backgrounds_dir.replace("gs://", "").split("/")[0]
+        bucket = backgrounds_dir[len("gs://"):].partition("/")[0]
         return get_gcs_path(bucket, "backgrounds", bg_file)
     else:
         return os.path.join(backgrounds_dir, bg_file)
 
+# 队伍代码（如 HOU、GSW），会拼进 match_glob，只允许大写字母，避免通配符元字符改变匹配
+_TEAM_CODE_RE = re.compile(r"[A-Z]{2,4}")
+
 def get_player_paths(away_team, home_team, players_dir="players"):
     """根据队伍前缀自动查找球员图片并返回路径列表（支持GCS路径）"""
-    player_files = list_gcs_files(players_dir)
-    player_files = [f for f in player_files if f.endswith(".png")]
+    # 只列出两队的球员图片（GCS端过滤），边分页边按队伍前缀归类
+    # 不合法的队伍代码直接视为找不到球员图片
+    teams = sorted({t for t in (away_team, home_team) if isinstance(t, str) and _TEAM_CODE_RE.fullmatch(t)})
+    away_player_files, home_player_files = [], []
+    if teams:
+        team_glob = teams[0] if len(teams) == 1 else f"{{{','.join(teams)}}}"
+        for f in iter_gcs_files(players_dir, match_glob=f"{team_glob}_*.png"):
+            if f.startswith(f"{away_team}_"):
+                away_player_files.append(f)
+            if f.startswith(f"{home_team}_"):
+                home_player_files.append(f)
     
     # 查找 away_team 的球员图片
-    away_player_files = [f for f in player_files if f.startswith(f"{away_team}_")]
     player1_file = random.choice(away_player_files) if away_player_files else None
     
     # 查找 home_team 的球员图片
-    home_player_files = [f for f in player_files if f.startswith(f"{home_team}_")]
     player2_file = random.choice(home_player_files) if home_player_files else None
     
-    if not player1_file:
-        print(f"警告：未找到 {away_team} 的球员图片")
-    if not player2_file:
-        print(f"警告：未找到 {home_team} 的球员图片")
-    
-    if player1_file:
-        print(f"找到客场球员图片: {player1_file}")
-    if player2_file:
-        print(f"找到主场球员图片: {player2_file}")
+    # 汇总查找结果，输出一行日志
+    search_msgs = [
+        f"找到客场球员图片: {player1_file}" if player1_file else f"警告：未找到 {away_team} 的球员图片",
+        f"找到主场球员图片: {player2_file}" if player2_file else f"警告：未找到 {home_team} 的球员图片",
+    ]
+    print(" | ".join(search_msgs))
     
     # 构建球员路径列表（只包含找到的球员图片）
-    player_paths = []
-    if player1_file:
-        if is_gcs_path(players_dir):
-            from gcs_utils import get_gcs_path
-            bucket = players_dir.replace("gs://", "").split("/")[0]
-            player_paths.append(get_gcs_path(bucket, "players", player1_file))
-        else:
-            player_paths.append(os.path.join(players_dir, player1_file))
-    if player2_file:
-        if is_gcs_path(players_dir):
-            from gcs_utils import get_gcs_path
-            bucket = players_dir.replace("gs://", "").split("/")[0]
-            player_paths.append(get_gcs_path(bucket, "players", player2_file))
-        else:
-            player_paths.append(os.path.join(players_dir, player2_file))
-    
-    return player_paths
+    player_files = [f for f in (player1_file, player2_file) if f]
+    if is_gcs_path(players_dir):
+        from gcs_utils import get_gcs_path
+        bucket = players_dir[len("gs://"):].partition("/")[0]
+        return [get_gcs_path(bucket, "players", f) for f in player_files]
+    return [os.path.join(players_dir, f) for f in player_files]
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="生成NBA奇门球探风格封面图")